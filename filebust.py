@@ -1,195 +1,537 @@
 #!/usr/bin/env python3
 """Error-Proof Media Optimizer - Thread-safe parallel processing"""
-import os, sys, argparse, subprocess, shutil, hashlib
+import os, sys, argparse, subprocess, shutil, hashlib, mmap, queue, time, errno, atexit, weakref
 from pathlib import Path
-from typing import Optional
-from concurrent.futures import ThreadPoolExecutor
-from threading import Lock
+from collections import defaultdict
+from typing import Callable, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock, Thread
+_sha256_backend = hashlib.sha256  # OpenSSL EVP when linked: picks SHA-NI/AVX2 block loops by CPUID
+try:
+    import blake3  # Optional: SIMD tree hash, much faster than SHA-256 for dedup
+except ImportError:
+    blake3 = None
+def _make_hasher(algo: str = "sha256", threads: int = 1):
+    """Hasher for algo ("sha256" or "blake3") on the fastest available backend"""
+    if algo == "blake3": return blake3.blake3(max_threads=threads)
+    return _sha256_backend()
+def _walk(folder, sort: bool = False):
+    """Recursively yield file DirEntry objects; scandir caches type and stat results"""
+    try:
+        with os.scandir(folder) as it:
+            # Sorting each directory by name gives the same order as sorting full paths, without materializing the tree
+            for entry in (sorted(it, key=lambda e: e.name) if sort else it):
+                if entry.is_dir(follow_symlinks=False): yield from _walk(entry.path, sort)
+                elif entry.is_file(): yield entry
+    except OSError:
+        pass  # Unreadable directory: skip it, as rglob does
+def _move(src: str, dst: str):
+    """Rename within a filesystem; across filesystems copy in-kernel, then unlink"""
+    try:
+        return os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV or not hasattr(os, "copy_file_range"): return shutil.move(src, dst)
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30): pass
+    except OSError:  # Kernel can't copy_file_range across these filesystems
+        return shutil.move(src, dst)
+    shutil.copystat(src, dst)
+    os.unlink(src)
+HASH_BATCH = 8  # Files per hash task; also how many files get read-ahead queued at once
+MMAP_MIN = 1 << 20  # Below this, mmap setup costs more than chunked reads
+HEAD_BYTES = 4096  # Partial fingerprint size for the dedup prefilter
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp")
+IMAGE_BATCH = 32  # Images converted per ffmpeg process
+VIDEO_ENCODERS = {  # --encoder auto tries these in order; "{crf}"/"{preset}" are filled in per quality
+    "nvenc": ["-c:v", "hevc_nvenc", "-preset", "p4", "-rc", "vbr", "-cq", "{crf}"],
+    "qsv": ["-c:v", "hevc_qsv", "-global_quality", "{crf}"],
+    "vaapi": ["-vaapi_device", "/dev/dri/renderD128", "-vf", "format=nv12,hwupload", "-c:v", "hevc_vaapi", "-qp", "{crf}"],
+    "x265": ["-c:v", "libx265", "-preset", "{preset}", "-crf", "{crf}"],
+}
+LOG_INTERVAL = 0.01  # Logger thread batching window (seconds)
+LOG_QUEUE = 10000  # Pending log lines before workers block
+LOG_IDLE = 0.5  # Logger thread exits after this long without lines (seconds)
+_live_optimizers = weakref.WeakSet()  # Flushed at exit so no queued line is lost
+atexit.register(lambda: [o.flush_log() for o in list(_live_optimizers)])
+MEDIA_CONFIG = {  # type: (extensions, output extension, output args); "{video}" expands to the encoder's args
+    "video": ((".mp4", ".mkv", ".avi", ".mov", ".webm"), ".mp4",
+              ("{video}", "-c:a", "aac", "-b:a", "96k", "-movflags", "+faststart")),
+    "audio": ((".mp3", ".wav", ".aac", ".flac", ".m4a"), ".opus", ("-c:a", "libopus", "-b:a", "96k")),
+    "image": (IMAGE_EXTS, ".webp", ("-c:v", "libwebp", "-q:v", "{webp_q}")),
+}
+X265_PRESETS = ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow", "placebo"]
 class MediaOptimizer:
     """Single-function master class for media optimization"""
-    def __init__(self, verbose: bool = False):
+    def __init__(self, verbose: bool = False, encoder: str = "auto",
+                 x265_preset: Optional[str] = None, x265_tune: Optional[str] = None, hash_algo: str = "sha256"):
         self.verbose = verbose
+        self.hash_algo = hash_algo  # Dedup fingerprint: "sha256" or "blake3"
+        self.encoder = encoder  # "auto" is resolved on the first video job
+        self.x265_preset = x265_preset  # None: veryfast, ultrafast at low quality
+        self.x265_tune = x265_tune
+        # Extension -> (media type, output extension), flattened once instead of scanned per file
+        self.ext_to_cfg = {ext: (mtype.capitalize(), out_ext)
+                           for mtype, (exts, out_ext, _) in MEDIA_CONFIG.items() for ext in exts}
+        self.args_cache = {}  # (media type, quality) -> resolved output args
         self.stats = {"processed": 0, "errors": 0, "old_size": 0, "new_size": 0}
         self.lock = Lock()  # Thread-safe stats updates
+        self.probe_lock = Lock()  # Single encoder probe across worker threads
+        self.log_queue = queue.Queue(LOG_QUEUE)  # Lines waiting for the logger thread
+        self.log_lock = Lock()  # Guards starting/stopping the logger thread
+        self.log_thread = None  # Started on demand, exits when idle
+        _live_optimizers.add(self)
     def log(self, msg: str, error: bool = False):
-        """Thread-safe logging with error tracking"""
-        print(f"{'⚠️' if error else 'ℹ️'} {msg}")
+        """Thread-safe logging with error tracking; the logger thread does the writing"""
+        # Under log_lock so an idle writer can't exit between the check and the put; the writer only
+        # takes the lock once the queue is empty, so a put() waiting on a full queue can't deadlock
+        with self.log_lock:
+            if self.log_thread is None:
+                self.log_thread = Thread(target=self._log_writer, daemon=True)
+                self.log_thread.start()
+            self.log_queue.put(f"{'⚠️' if error else 'ℹ️'} {msg}\n")
         if error:
             with self.lock:
                 self.stats["errors"] += 1
-    def safe_hash(self, path: Path) -> Optional[str]:
-        """Calculate file hash with error handling"""
+    def _log_writer(self):
+        """Write queued lines in one batch per LOG_INTERVAL so workers never wait on stdout"""
+        while True:
+            try:
+                batch = [self.log_queue.get(timeout=LOG_IDLE)]
+            except queue.Empty:
+                with self.log_lock:  # A log() that finds log_thread None starts a new writer
+                    if self.log_queue.empty():
+                        self.log_thread = None
+                        return
+                continue
+            time.sleep(LOG_INTERVAL)  # Let other workers' lines pile up
+            try:
+                while True: batch.append(self.log_queue.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                sys.stdout.write("".join(batch))
+                sys.stdout.flush()
+            except Exception:
+                pass  # Never let a broken stdout stall flush_log()
+            finally:
+                for _ in batch: self.log_queue.task_done()
+    def flush_log(self):
+        """Block until every queued log line has been written"""
+        self.log_queue.join()
+    def safe_hash(self, path: Path) -> tuple:
+        """Calculate file hash with error handling, as (path, digest or None)"""
         try:
-            h = hashlib.sha256()
+            h = _make_hasher(self.hash_algo)
             with open(path, "rb") as f:
-                for chunk in iter(lambda: f.read(8192), b""):
-                    h.update(chunk)
-            return h.hexdigest()
+                if os.fstat(f.fileno()).st_size < MMAP_MIN:
+                    for chunk in iter(lambda: f.read(8192), b""):
+                        h.update(chunk)
+                elif self.hash_algo == "blake3":  # Maps the file itself and splits the tree across cores
+                    h = _make_hasher("blake3", blake3.blake3.AUTO).update_mmap(path)
+                else:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        if hasattr(mm, "madvise"):  # Aggressive read-ahead (Unix only)
+                            mm.madvise(mmap.MADV_SEQUENTIAL)
+                            mm.madvise(mmap.MADV_WILLNEED)
+                        h.update(mm)  # One contiguous buffer, hashed without the GIL
+            return path, h.digest()
         except Exception as e:
             self.log(f"Hash failed for {path.name}: {e}", error=True)
-            return None
-    def safe_run(self, cmd: list) -> bool:
-        """Execute command with comprehensive error handling"""
+            return path, None
+    def safe_hash_head(self, path: Path) -> tuple:
+        """Hash only the first HEAD_BYTES as a cheap fingerprint, as (path, digest or None)"""
+        try:
+            h = _make_hasher(self.hash_algo)
+            with open(path, "rb") as f:
+                h.update(f.read(HEAD_BYTES))
+            return path, h.digest()
+        except Exception as e:
+            self.log(f"Hash failed for {path.name}: {e}", error=True)
+            return path, None
+    def safe_framehash(self, path: Path) -> tuple:
+        """Fingerprint a video by its decoded frames (every 30th video, all audio), as (path, digest or None)"""
+        # Audio is hashed too: same picture with a different soundtrack (dub, commentary) is not a duplicate
+        cmd = ["ffmpeg", "-v", "error", "-i", str(path), "-map", "0:v:0?", "-map", "0:a?",
+               "-vf", "select='not(mod(n,30))'", "-vsync", "0", "-f", "framehash", "-"]
+        try:
+            out = subprocess.run(cmd, check=True, capture_output=True, text=True, timeout=300).stdout
+        except subprocess.CalledProcessError as e:
+            self.log(f"Framehash failed for {path.name}: {e.stderr[:100]}", error=True)
+            return path, None
+        except Exception as e:
+            self.log(f"Framehash failed for {path.name}: {type(e).__name__}: {e}", error=True)
+            return path, None
+        lines = out.splitlines()
+        if not any(line.startswith("#media_type") and line.endswith("video") for line in lines):
+            return path, None  # No video stream (e.g. audio-only .mp4): nothing to compare
+        # Keep stream index + frame hash: timestamps and time bases differ between containers
+        frames = [f"{line.split(',', 1)[0]},{line.rsplit(',', 1)[-1].strip()}"
+                  for line in lines if line and not line.startswith("#")]
+        if not frames: return path, None
+        h = _make_hasher()
+        h.update("\n".join(frames).encode())
+        return path, h.digest()
+    def safe_hash_batch(self, paths: list) -> list:
+        """Hash a group of files, queuing read-ahead for the whole group first, as (path, digest or None) pairs"""
+        if hasattr(os, "posix_fadvise"):  # Kernel reads the rest of the group while the first files hash (Linux/BSD)
+            for path in paths:
+                try:
+                    fd = os.open(path, os.O_RDONLY)
+                    try:
+                        if os.fstat(fd).st_size < MMAP_MIN:  # Large files get madvise on the mmap path instead
+                            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                    finally:
+                        os.close(fd)
+                except OSError:
+                    pass  # Only a hint: safe_hash reports unreadable files
+        return [self.safe_hash(p) for p in paths]
+    def safe_run(self, cmd: list, error: bool = True) -> bool:
+        """Execute command with comprehensive error handling; error=False logs failures without counting them"""
         try:
             if self.verbose: self.log(f"Running: {' '.join(cmd)}")
             subprocess.run(cmd, check=True, capture_output=True, text=True, timeout=300)
             return True
         except subprocess.TimeoutExpired:
-            self.log(f"Command timeout: {cmd[0]}", error=True)
+            self.log(f"Command timeout: {cmd[0]}", error=error)
         except subprocess.CalledProcessError as e:
-            self.log(f"Command failed: {e.stderr[:100]}", error=True)
+            self.log(f"Command failed: {e.stderr[:100]}", error=error)
         except FileNotFoundError:
-            self.log(f"Tool not found: {cmd[0]} - install ffmpeg!", error=True)
+            self.log(f"Tool not found: {cmd[0]} - install ffmpeg!", error=error)
         except Exception as e:
-            self.log(f"Unexpected error: {type(e).__name__}: {e}", error=True)
+            self.log(f"Unexpected error: {type(e).__name__}: {e}", error=error)
         return False
+    def video_encoder(self) -> str:
+        """Resolve the video encoder, probing ffmpeg once for working hardware encoders"""
+        with self.probe_lock:
+            if self.encoder == "auto":
+                self.encoder = self._probe_encoder()
+                if self.verbose: self.log(f"Video encoder: {self.encoder}")
+            return self.encoder
+    def _probe_encoder(self) -> str:
+        """First hardware encoder that is built in and can encode a test frame, else x265"""
+        try:
+            listed = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"],
+                                    capture_output=True, text=True, timeout=30).stdout
+            for name, args in VIDEO_ENCODERS.items():
+                if name == "x265" or args[args.index("-c:v") + 1] not in listed: continue
+                # Listed only means compiled in; a one-frame encode proves the device is there
+                test = ["ffmpeg", "-hide_banner", "-f", "lavfi", "-i", "color=s=256x256:d=0.1", "-frames:v", "1",
+                        *[{"{crf}": "28"}.get(a, a) for a in args], "-f", "null", "-"]
+                if subprocess.run(test, capture_output=True, timeout=30).returncode == 0: return name
+        except (OSError, subprocess.SubprocessError):
+            pass
+        return "x265"
     def human_size(self, size: int) -> str:
         """Convert bytes to human readable format"""
-        for unit in ["B", "KB", "MB", "GB", "TB"]:
-            if size < 1024.0: return f"{size:.1f}{unit}"
-            size /= 1024.0
-        return f"{size:.1f}PB"
-    def transcode(self, src: Path, quality: str = "medium") -> Optional[Path]:
-        """Transcode media with full error handling"""
+        idx = min(max(0, (int(size).bit_length() - 1) // 10), 5)  # Unit straight from the bit length
+        return f"{size / (1 << (10 * idx)):.1f}{'BKMGTP'[idx] + 'B' if idx else 'B'}"
+    def _output_args(self, media_type: str, quality: str) -> tuple:
+        """Output args for a media type at a quality, filled in from its template once"""
+        args = self.args_cache.get((media_type, quality))
+        if args is None:
+            fill = {"{crf}": str({"low": 32, "medium": 28, "high": 23}.get(quality, 28)),
+                    "{preset}": self.x265_preset or ("ultrafast" if quality == "low" else "veryfast"),
+                    "{webp_q}": {"low": "70", "medium": "80", "high": "90"}.get(quality, "80")}
+            args = []
+            for a in MEDIA_CONFIG[media_type.lower()][2]:
+                if a != "{video}":
+                    args.append(fill.get(a, a))
+                    continue
+                encoder = self.video_encoder()  # Only video jobs ever probe for encoders
+                args += [fill.get(v, v) for v in VIDEO_ENCODERS[encoder]]
+                if encoder == "x265" and self.x265_tune: args += ["-tune", self.x265_tune]
+            self.args_cache[media_type, quality] = args = tuple(args)
+        return args
+    def _plan(self, src: Path, quality: str = "medium") -> Optional[tuple]:
+        """Build a (src, dst, media_type, cmd) transcode job, None if unsupported"""
+        cfg = self.ext_to_cfg.get(src.suffix.lower())
+        if cfg is None: return None  # Unsupported: decided before touching the filesystem
         if not src.exists() or not src.is_file():
             self.log(f"Invalid source: {src}", error=True)
             return None
-        ext = src.suffix.lower()
-        qmap = {"low": 32, "medium": 28, "high": 23}
-        crf = qmap.get(quality, 28)
-        # Determine output format and command
-        config = {
-            "video": ([".mp4", ".mkv", ".avi", ".mov", ".webm"], ".mp4", 
-                     ["ffmpeg", "-y", "-i", str(src), "-c:v", "libx265", "-preset", "medium", 
-                      "-crf", str(crf), "-c:a", "aac", "-b:a", "96k", "-movflags", "+faststart"]),
-            "audio": ([".mp3", ".wav", ".aac", ".flac", ".m4a"], ".opus",
-                     ["ffmpeg", "-y", "-i", str(src), "-c:a", "libopus", "-b:a", "96k"]),
-            "image": ([".jpg", ".jpeg", ".png", ".bmp"], ".webp",
-                     ["ffmpeg", "-y", "-i", str(src), "-c:v", "libwebp", "-q:v", 
-                      {"low": "70", "medium": "80", "high": "90"}[quality]])
-        }
-        media_type = dst = cmd = None
-        for mtype, (exts, out_ext, base_cmd) in config.items():
-            if ext in exts:
-                media_type = mtype.capitalize()
-                dst = src.with_stem(f"{src.stem}_opt").with_suffix(out_ext)
-                cmd = base_cmd + [str(dst)]
-                break
-        if not cmd: return None
+        media_type, out_ext = cfg
+        dst = src.with_stem(f"{src.stem}_opt").with_suffix(out_ext)
+        return src, dst, media_type, ("ffmpeg", "-y", "-i", str(src)) + self._output_args(media_type, quality) + (str(dst),)
+    def _dispatch(self, jobs: list) -> bool:
+        """Run jobs in one ffmpeg process: N inputs, each mapped to its own output"""
+        if len(jobs) == 1: return self.safe_run(jobs[0][3])
+        cmd = ["ffmpeg", "-y"]
+        for _, _, _, job_cmd in jobs: cmd += job_cmd[2:4]  # -i <src>
+        for i, (_, _, _, job_cmd) in enumerate(jobs): cmd += ["-map", f"{i}:v", *job_cmd[4:]]  # options + <dst>
+        return self.safe_run(cmd, error=False)  # Not an error yet: each job is retried on its own
+    def _finish(self, job: tuple, old_size: int) -> Optional[Path]:
+        """Keep a finished output only if it is smaller, then drop the original"""
+        src, dst, _, _ = job
+        if not dst.exists():
+            self.log(f"Output file not created: {dst}", error=True)
+            return None
+        new_size = dst.stat().st_size
+        
+        # Only keep if smaller
+        if new_size >= old_size:
+            self.log(f"⏩ Skipped (no savings): {src.name}")
+            dst.unlink(missing_ok=True)
+            return None
+        
+        saved = old_size - new_size
+        pct = (saved / old_size * 100)
+        self.log(f"✅ {src.name}: {self.human_size(old_size)} → {self.human_size(new_size)} ({pct:.1f}% saved)")
+        
+        # Thread-safe stats update
+        with self.lock:
+            self.stats["old_size"] += old_size
+            self.stats["new_size"] += new_size
+            self.stats["processed"] += 1
+        # Delete original after successful, smaller transcode
         try:
-            old_size = src.stat().st_size
-            self.log(f"🎬 Transcoding {media_type}: {src.name}")
-            if not self.safe_run(cmd): return None
-            if not dst.exists():
-                self.log(f"Output file not created: {dst}", error=True)
-                return None
-            new_size = dst.stat().st_size
-            
-            # Only keep if smaller
-            if new_size >= old_size:
-                self.log(f"⏩ Skipped (no savings): {src.name}")
-                dst.unlink(missing_ok=True)
-                return None
-            
-            saved = old_size - new_size
-            pct = (saved / old_size * 100)
-            self.log(f"✅ {src.name}: {self.human_size(old_size)} → {self.human_size(new_size)} ({pct:.1f}% saved)")
-            
-            # Thread-safe stats update
-            with self.lock:
-                self.stats["old_size"] += old_size
-                self.stats["new_size"] += new_size
-                self.stats["processed"] += 1
-            # Delete original after successful, smaller transcode
+            src.unlink()
+        except OSError as e:
+            self.log(f"Failed to remove original {src.name}: {e}", error=True)
+        return dst
+    def transcode(self, src: Path, quality: str = "medium") -> Optional[Path]:
+        """Transcode media with full error handling"""
+        return self.transcode_batch([src], quality)[0]
+    def transcode_batch(self, srcs: list, quality: str = "medium") -> list:
+        """Transcode files, sharing one ffmpeg process across all image jobs"""
+        jobs = [job for job in map(lambda s: self._plan(s, quality), srcs) if job]
+        results = dict.fromkeys(srcs)
+        images = [job for job in jobs if job[2] == "Image"]
+        # One process for every image; per-file processes for the rest (and for a failed batch)
+        batches = ([images] if len(images) > 1 else [[job] for job in images]) + \
+                  [[job] for job in jobs if job[2] != "Image"]
+        retried = set()  # Jobs of a failed merged batch, already announced
+        while batches:
+            batch = batches.pop(0)
             try:
-                src.unlink()
-            except OSError as e:
-                self.log(f"Failed to remove original {src.name}: {e}", error=True)
-            return dst
-            
-        except Exception as e:
-            self.log(f"Transcode failed for {src.name}: {e}", error=True)
-            if dst and dst.exists(): dst.unlink(missing_ok=True)
-            return None
+                old_sizes = [job[0].stat().st_size for job in batch]
+                for job in batch:
+                    if job[0] not in retried: self.log(f"🎬 Transcoding {job[2]}: {job[0].name}")
+                if not self._dispatch(batch):
+                    if len(batch) > 1:
+                        self.log(f"Retrying {len(batch)} images one per process")
+                        retried.update(job[0] for job in batch)
+                        batches[:0] = [[job] for job in batch]
+                    continue
+                for job, old_size in zip(batch, old_sizes): results[job[0]] = self._finish(job, old_size)
+            except Exception as e:
+                for src, dst, _, _ in batch:
+                    if results[src]: continue
+                    self.log(f"Transcode failed for {src.name}: {e}", error=True)
+                    if dst and dst.exists(): dst.unlink(missing_ok=True)
+        return [results[s] for s in srcs]
     
-    def deduplicate(self, folder: Path) -> int:
+    def deduplicate(self, folder: Path, threads: int = 4, sort: bool = False) -> int:
         """Remove duplicate files safely"""
-        seen, removed = {}, 0
+        removed, _ = self._dedup(self._sizes(folder, sort), threads)
+        self.flush_log()
+        return len(removed)
+    def _sizes(self, folder, sort: bool = False):
+        """Yield (path, size) for each file under folder, logging files that vanish or can't be stat'ed"""
+        for e in _walk(folder, sort):
+            try:
+                yield e.path, e.stat().st_size
+            except OSError as err:
+                self.log(f"Stat failed for {e.name}: {err}", error=True)
+    def _dedup(self, files, threads: int = 4) -> tuple:
+        """Remove duplicates among (path, size) pairs: size buckets, then head hashes, then full hashes.
+        Returns (removed paths, surviving (path, size) pairs)"""
+        seen, removed = {}, set()  # Raw 32-byte digest -> kept file; paths removed
+        size_map, order = defaultdict(list), []  # Each bucket keeps walk order; order is the whole walk
         try:
-            for f in sorted(folder.rglob("*")):
-                if not f.is_file(): continue
-                h = self.safe_hash(f)
+            for path, size in files:
+                size_map[size].append(path)
+                order.append((path, size))
+            # Files with a unique size can't have a duplicate: never read them
+            candidates, sizes, paths = [], {}, {}
+            for size, group in size_map.items():
+                if len(group) < 2: continue
+                for path in group:
+                    f = Path(path)
+                    candidates.append(f)
+                    sizes[f], paths[f] = size, path
+            digests = {}
+            with ThreadPoolExecutor(max_workers=threads) as ex:
+                head_map = defaultdict(list)
+                for f, h in ex.map(self.safe_hash_head, candidates):
+                    if h: head_map[sizes[f], h].append(f)
+                full = []
+                for (size, h), group in head_map.items():
+                    if len(group) < 2: continue
+                    if size <= HEAD_BYTES: digests.update((f, h) for f in group)  # Head is the whole file
+                    else: full.extend(group)
+                # Largest files first (LPT) so the slowest hashes don't trail at the end
+                full.sort(key=sizes.get, reverse=True)
+                groups = [full[i:i + HASH_BATCH] for i in range(0, len(full), HASH_BATCH)]
+                for pairs in ex.map(self.safe_hash_batch, groups): digests.update(pairs)
+            for f in candidates:  # Duplicates share a bucket, so walk order within it decides: first seen wins
+                h = digests.get(f)
                 if not h: continue
                 if h in seen:
                     try:
                         f.unlink()
                         self.log(f"🗑️ Removed duplicate: {f.name}")
-                        removed += 1
+                        removed.add(paths[f])
                     except OSError as e:
                         self.log(f"Failed to remove {f.name}: {e}", error=True)
                 else:
                     seen[h] = f
         except Exception as e:
             self.log(f"Deduplication error: {e}", error=True)
+        return removed, [(p, size) for p, size in order if p not in removed]
+    
+    def _perceptual_dedup(self, files: list, threads: int = 4) -> set:
+        """Remove videos whose decoded frames match an earlier one (remuxes, metadata edits)"""
+        removed, seen = set(), {}
+        videos = [Path(p) for p, _ in files if os.path.splitext(p)[1].lower() in MEDIA_CONFIG["video"][0]]
+        if len(videos) < 2: return removed
+        paths = {Path(p): p for p, _ in files}
+        with ThreadPoolExecutor(max_workers=threads) as ex:
+            for f, h in ex.map(self.safe_framehash, videos):  # map keeps walk order: first seen wins
+                if not h: continue
+                if h not in seen:
+                    seen[h] = f
+                    continue
+                try:
+                    f.unlink()
+                    self.log(f"🗑️ Removed perceptual duplicate: {f.name} (same frames as {seen[h].name})")
+                    removed.add(paths[f])
+                except OSError as e:
+                    self.log(f"Failed to remove {f.name}: {e}", error=True)
         return removed
     
-    def organize(self, folder: Path, mode: str = "type") -> int:
+    def organize(self, folder: Path, mode: str = "type", sort: bool = False) -> int:
         """Organize files by type/size with error handling"""
-        moved = 0
+        moved, root = 0, os.path.normpath(folder)  # Walk from root too, so entry paths share its prefix
         try:
-            for f in sorted(folder.rglob("*")):
-                if not f.is_file(): continue         
-                target_dir = folder / ((f.suffix.lower()[1:] or "noext") if mode == "type" 
-                                      else f"{f.stat().st_size // (1024 * 1024)}MB")        
-                if f.parent == target_dir: continue       
-                try:
-                    target_dir.mkdir(exist_ok=True, parents=True)
-                    shutil.move(str(f), target_dir / f.name)
-                    self.log(f"📂 Moved: {f.name} → {target_dir.name}")
-                    moved += 1
-                except (OSError, shutil.Error) as e:
-                    self.log(f"Move failed for {f.name}: {e}", error=True)
+            for f in _walk(root, sort):  # Files already in place are skipped if the walk reaches them again
+                size = f.stat().st_size if mode == "size" else 0  # Cached on the entry: one stat at most
+                if self._organize_one(f.path, size, mode, root) != f.path: moved += 1
         except Exception as e:
             self.log(f"Organization error: {e}", error=True)
+        self.flush_log()
         return moved
+    def _organize_one(self, path: str, size: int, mode: str, root: str) -> str:
+        """Move one file into its type/size folder under root; returns where it now lives"""
+        name = os.path.basename(path)
+        bucket = (os.path.splitext(name)[1].lower()[1:] or "noext") if mode == "type" else f"{size >> 20}MB"
+        target_dir = os.path.join(root, bucket)
+        if os.path.dirname(path) == target_dir: return path
+        try:
+            os.makedirs(target_dir, exist_ok=True)
+            dst = os.path.join(target_dir, name)
+            _move(path, dst)
+            self.log(f"📂 Moved: {name} → {bucket}")
+            return dst
+        except (OSError, shutil.Error) as e:
+            self.log(f"Move failed for {name}: {e}", error=True)
+            return path
+    def _process_file(self, path: str, size: int, organize: Optional[str], transcode: bool,
+                      quality: str, root: str) -> str:
+        """Organize then transcode one file; returns its path after the move"""
+        try:
+            if organize: path = self._organize_one(path, size, organize, root)
+            if transcode: self.transcode(Path(path), quality)
+        except Exception as e:
+            self.log(f"Processing failed for {os.path.basename(path)}: {e}", error=True)
+        return path
+    def process(self, folder: Path, threads: int = 4, dedup: bool = False, organize: Optional[str] = None,
+                transcode: bool = False, quality: str = "medium", sort: bool = False,
+                perceptual: bool = False, report: Optional[Callable[[str, int], None]] = None) -> dict:
+        """Walk the tree once, then dedup, organize and transcode from that listing on one worker pool.
+        report(phase, count) is called as each of the removed/perceptual/moved phases ends"""
+        counts = {"removed": 0, "perceptual": 0, "moved": 0}
+        def done(phase: str):
+            self.flush_log()  # The phase's own log lines come before its count
+            if report: report(phase, counts[phase])
+        root = os.path.normpath(folder)
+        files = self._sizes(root, sort)  # Streamed straight into dedup's size buckets or the worker pool
+        if dedup:
+            removed, files = self._dedup(files, threads)
+            counts["removed"] = len(removed)
+            done("removed")
+        if perceptual:  # After the byte pass, so exact copies never reach ffmpeg
+            files = list(files)
+            removed = self._perceptual_dedup(files, threads)
+            counts["perceptual"] = len(removed)
+            done("perceptual")
+            files = [(p, size) for p, size in files if p not in removed]
+        if not (organize or transcode):
+            self.flush_log()
+            return counts
+        is_image = lambda p: transcode and os.path.splitext(p)[1].lower() in IMAGE_EXTS
+        per_batch = 1
+        if transcode:  # Largest first (LPT) so long encodes start early instead of trailing at the end
+            files = sorted(files, key=lambda f: f[1], reverse=True)
+            # Images share processes: spread over all workers, at most IMAGE_BATCH per ffmpeg
+            per_batch = max(1, min(IMAGE_BATCH, -(-sum(1 for p, _ in files if is_image(p)) // threads)))
+        pending, futures = [], {}
+        with ThreadPoolExecutor(max_workers=threads) as ex:
+            def queue_image(p: str):
+                """Batch an image whose final path is known; submit each batch as soon as it fills"""
+                pending.append(Path(p))
+                if len(pending) >= per_batch:
+                    ex.submit(self.transcode_batch, pending[:], quality)
+                    pending.clear()
+            for p, size in files:
+                if is_image(p) and not organize:
+                    queue_image(p)  # Already where it stays: no organize step to wait for
+                    continue
+                futures[ex.submit(self._process_file, p, size, organize, transcode and not is_image(p),
+                                  quality, root)] = p
+            for fut in as_completed(futures):
+                p = fut.result()
+                if p != futures[fut]: counts["moved"] += 1
+                if is_image(p): queue_image(p)
+            if organize: done("moved")  # Every file is in place; transcodes may still be running
+            if pending: ex.submit(self.transcode_batch, pending, quality)
+        self.flush_log()
+        return counts
 def main():
     p = argparse.ArgumentParser(description="Error-Proof Media Optimizer")
     p.add_argument("folder", help="Target folder")
     p.add_argument("--transcode", action="store_true", help="Transcode media files")
     p.add_argument("--quality", choices=["low", "medium", "high"], default="medium")
+    p.add_argument("--encoder", choices=["auto", *VIDEO_ENCODERS], default="auto",
+                   help="Video encoder (default: auto = first working of nvenc, qsv, vaapi, x265)")
+    p.add_argument("--x265-preset", choices=X265_PRESETS,
+                   help="libx265 preset (default: veryfast, ultrafast with --quality low)")
+    p.add_argument("--x265-tune", choices=["psnr", "ssim", "grain", "zerolatency", "fastdecode", "animation"],
+                   help="libx265 tune (default: none)")
     p.add_argument("--dedup", action="store_true", help="Remove duplicates")
+    p.add_argument("--perceptual-dedup", action="store_true",
+                   help="Remove videos whose decoded frames match (remuxes, metadata edits)")
+    p.add_argument("--hash", choices=["sha256", "blake3"], default="blake3" if blake3 else "sha256",
+                   help="Dedup hash (default: blake3 if installed, else sha256)")
     p.add_argument("--organize", choices=["type", "size"], help="Organize files")
+    p.add_argument("--sort", action="store_true", help="Walk files in sorted path order (deterministic duplicate keeper)")
     p.add_argument("--threads", type=int, default=4, help="Parallel workers (default: 4)")
     p.add_argument("--verbose", action="store_true", help="Verbose output")
     args = p.parse_args()
     folder = Path(args.folder)
     if not folder.exists() or not folder.is_dir(): sys.exit("❌ Invalid folder path!")
-    optimizer = MediaOptimizer(verbose=args.verbose)
+    if args.hash == "blake3" and not blake3: sys.exit("❌ --hash blake3 needs: pip install blake3")
+    optimizer = MediaOptimizer(verbose=args.verbose, encoder=args.encoder,
+                               x265_preset=args.x265_preset, x265_tune=args.x265_tune, hash_algo=args.hash)
+    labels = {"removed": "Removed {} duplicates", "perceptual": "Removed {} perceptual duplicates",
+              "moved": "Organized {} files"}
     try:
-        if args.dedup:
-            removed = optimizer.deduplicate(folder)
-            print(f"\n✨ Removed {removed} duplicates")
-        
-        if args.organize:
-            moved = optimizer.organize(folder, args.organize)
-            print(f"\n✨ Organized {moved} files")
+        optimizer.process(folder, args.threads, args.dedup, args.organize, args.transcode, args.quality,
+                          args.sort, args.perceptual_dedup, lambda phase, n: print(f"\n✨ {labels[phase].format(n)}"))
         
-        if args.transcode:
-            files = [f for f in folder.rglob("*") if f.is_file()]
-            with ThreadPoolExecutor(max_workers=args.threads) as ex:
-                list(ex.map(lambda f: optimizer.transcode(f, args.quality), files))
-            
-            if optimizer.stats["processed"] > 0:
-                saved = optimizer.stats["old_size"] - optimizer.stats["new_size"]
-                pct = (saved / optimizer.stats["old_size"] * 100)
-                print(f"\n🎉 Summary: {optimizer.stats['processed']} files | "
-                      f"Saved: {optimizer.human_size(saved)} ({pct:.1f}%) | "
-                      f"Errors: {optimizer.stats['errors']}")
+        if args.transcode and optimizer.stats["processed"] > 0:
+            saved = optimizer.stats["old_size"] - optimizer.stats["new_size"]
+            pct = (saved / optimizer.stats["old_size"] * 100)
+            print(f"\n🎉 Summary: {optimizer.stats['processed']} files | "
+                  f"Saved: {optimizer.human_size(saved)} ({pct:.1f}%) | "
+                  f"Errors: {optimizer.stats['errors']}")
         
     except KeyboardInterrupt:
+        optimizer.flush_log()
         print("\n⚠️ Interrupted by user")
         sys.exit(1)
     except Exception as e:
+        optimizer.flush_log()
         print(f"\n❌ Fatal error: {type(e).__name__}: {e}")
         sys.exit(1)
 